@@ -0,0 +1,98 @@
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+from torch.utils.data import DataLoader, RandomSampler
+
+from py.custom_dataset import CustomClassificationDataset
+
+# 调优结果的缓存文件，按 "主机名-CPU 核心数-worker 上限" 保存，下次运行直接复用
+AUTOTUNE_CACHE = Path(".cache") / "autotune.json"
+
+
+def _load_cache() -> dict:
+    try:
+        return json.loads(AUTOTUNE_CACHE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def benchmark_workers(dataset, num_workers: int, batch: int = 32, prefetch_factor: int = 2, rounds: int = 3) -> float:
+    """
+    测量给定 worker 数下数据加载的稳态吞吐量。
+
+    先预热 `num_workers * prefetch_factor` 个批次，使每个 worker 都已启动并完成首个批次
+    （包括进程启动和 collate_fn 中的按需初始化），再计时 `rounds` 轮、每轮每个 worker 一个批次。
+
+    Args:
+        dataset (CustomClassificationDataset): 用于测试的数据集。
+        num_workers (int): DataLoader 的 worker 数。
+        batch (int): 批大小。
+        prefetch_factor (int): 每个 worker 预取的批次数，与训练时保持一致。
+        rounds (int): 计时的轮数。
+
+    Returns:
+        (float): 每秒加载的图片数。
+    """
+    warmup = max(1, num_workers * prefetch_factor)
+    num_batches = rounds * max(1, num_workers)
+    sampler = RandomSampler(dataset, replacement=True, num_samples=batch * (warmup + num_batches))
+    loader = DataLoader(dataset, batch_size=batch, sampler=sampler, num_workers=num_workers,
+                        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                        collate_fn=dataset.collate_fn)
+    it = iter(loader)
+    for _ in range(warmup):
+        next(it)  # 预热：排除 worker 启动和首个批次的开销
+    t0 = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)
+    elapsed = time.perf_counter() - t0
+    del it, loader
+    return batch * num_batches / elapsed
+
+
+def autotune_workers(data_dir: str, imgsz: int = 224, candidates=None, prefetch_factor: int = 2, force=False) -> int:
+    """
+    通过短时间的预热基准测试，为当前机器选出数据加载吞吐量最高的 worker 数。
+
+    Args:
+        data_dir (str): 清理后数据集的路径，使用其中的 train 划分进行测试。
+        imgsz (int): 训练输入尺寸。
+        candidates (list, optional): 候选 worker 数，默认 {cpu/2, cpu, 2*cpu}，
+            并按 Ultralytics 的规则截断到 cpu_count // GPU 数后去重。
+        prefetch_factor (int): 每个 worker 预取的批次数，与训练时保持一致。
+        force (bool): 忽略缓存的结果重新测试。
+
+    Returns:
+        (int): 吞吐量最高的 worker 数。
+    """
+    from ultralytics.cfg import get_cfg
+
+    import torch
+
+    cpus = os.cpu_count() or 1
+    # 与 Ultralytics build_dataloader 相同的上限：每张 GPU 最多 cpu_count // n_gpus 个 worker，
+    # 超过该值的候选在训练时会被截断，测出来也用不上
+    max_workers = max(1, cpus // max(torch.cuda.device_count(), 1))
+    key = f"{socket.gethostname()}-{cpus}-{max_workers}"
+    cache = _load_cache()
+    if key in cache and not force:
+        print(f"✅ 使用缓存的自动调优结果: workers={cache[key]} ({AUTOTUNE_CACHE})")
+        return cache[key]
+
+    candidates = sorted({min(max(1, w), max_workers) for w in (candidates or [cpus // 2, cpus, 2 * cpus])})
+    dataset = CustomClassificationDataset(str(Path(data_dir) / "train"), get_cfg(overrides={"imgsz": imgsz}))
+    print(f"--- 自动调优数据加载 worker 数，候选: {candidates} ---")
+    results = {}
+    for w in candidates:
+        results[w] = benchmark_workers(dataset, w, prefetch_factor=prefetch_factor)
+        print(f"workers={w}: {results[w]:.1f} 张/秒")
+    best = max(results, key=results.get)
+
+    cache[key] = best
+    AUTOTUNE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    AUTOTUNE_CACHE.write_text(json.dumps(cache, indent=2))
+    print(f"✅ 自动调优完成: workers={best}")
+    return best
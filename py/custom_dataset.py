@@ -1,53 +1,367 @@
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
 import cv2
 import numpy as np
+import torch
 from PIL import Image
+from torch import nn
+from torch.utils.data import Dataset
+from torchvision.transforms import v2
 
+from ultralytics.data.augment import DEFAULT_MEAN, DEFAULT_STD
 from ultralytics.data.dataset import ClassificationDataset
 from ultralytics.utils import LOGGER
 
+# PyTurboJPEG 为可选依赖：可用时直接调用 libjpeg-turbo 的 SIMD 解码路径，
+# 否则回退到 Pillow。TurboJPEG 实例在 fork 之后可以被各 worker 安全复用。
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+
+    _TJ = TurboJPEG()
+except (ImportError, OSError):
+    _TJ = None
+
+JPEG_SUFFIXES = {".jpg", ".jpeg"}
+
+
+class Normalize(nn.Module):
+    """把 uint8 图像批次转换为 float32 并归一化；逐元素运算，适合用 torch.compile 融合为单个内核。"""
+
+    def __init__(self, mean=DEFAULT_MEAN, std=DEFAULT_STD):
+        super().__init__()
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32).view(-1, 1, 1))
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32).view(-1, 1, 1))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return (x.to(torch.float32) / 255.0 - self.mean) / self.std
+
+
+# 每个进程只编译一次的 Normalize（torch.compile 结果无法跨进程共享，也无法被 pickle），
+# 仅由 normalize_compiled 读写
+_COMPILED_NORMALIZE = None
+_COMPILE_FAILED = False
+
+
+def normalize_compiled(module: nn.Module, imgs: torch.Tensor) -> torch.Tensor:
+    """
+    用当前进程内共享的、torch.compile 编译后的 `module` 归一化一个批次。以 dynamic=True 编译，
+    批大小从一开始就是动态维度，每个 epoch 最后一个较小的批次不会触发重新编译。
+    编译或执行失败时记录下来，之后在本进程内直接使用未编译的 `module`。
+
+    Args:
+        module (nn.Module): 未编译的归一化模块。
+        imgs (torch.Tensor): uint8 图像批次。
+
+    Returns:
+        (torch.Tensor): 归一化后的 float32 批次。
+    """
+    global _COMPILED_NORMALIZE, _COMPILE_FAILED
+    if not _COMPILE_FAILED:
+        try:
+            if _COMPILED_NORMALIZE is None:
+                _COMPILED_NORMALIZE = torch.compile(module, dynamic=True)
+            return _COMPILED_NORMALIZE(imgs)
+        except Exception as e:
+            LOGGER.warning(f"WARNING ⚠️ torch.compile unavailable for Normalize, using eager mode: {e}")
+            _COMPILE_FAILED = True
+    return module(imgs)
+
+
+def build_tensor_transforms(size: int, args, augment: bool = False, normalize: bool = True) -> v2.Compose:
+    """
+    构建直接作用于 uint8 CHW 张量的 torchvision v2 分类变换，对应 Ultralytics 的
+    `classify_transforms` / `classify_augmentations`，但无需先构造 PIL 图像。
+
+    Args:
+        size (int): 输出图像边长。
+        args (IterableSimpleNamespace): 训练超参数。
+        augment (bool): 是否使用训练增强。未知的 `args.auto_augment` 会引发 ValueError。
+        normalize (bool): 是否在末尾转换为 float32 并归一化。为 False 时输出 uint8 张量，
+            由调用方对整个批次统一做归一化（见 `Normalize`）。
+
+    Returns:
+        (v2.Compose): 变换流水线。
+    """
+    tail = [v2.ToDtype(torch.float32, scale=True), v2.Normalize(DEFAULT_MEAN, DEFAULT_STD)] if normalize else []
+    if not augment:
+        return v2.Compose([
+            v2.ToImage(),
+            v2.Resize(size, interpolation=v2.InterpolationMode.BILINEAR),
+            v2.CenterCrop(size),
+            *tail,
+        ])
+
+    tfl = [
+        v2.ToImage(),
+        v2.RandomResizedCrop(size, scale=(1.0 - args.scale, 1.0), interpolation=v2.InterpolationMode.BILINEAR),
+    ]
+    if args.fliplr > 0.0:
+        tfl.append(v2.RandomHorizontalFlip(p=args.fliplr))
+    if args.flipud > 0.0:
+        tfl.append(v2.RandomVerticalFlip(p=args.flipud))
+    auto_augment = args.auto_augment
+    if not auto_augment:
+        tfl.append(v2.ColorJitter(args.hsv_v, args.hsv_v, args.hsv_s, args.hsv_h))
+    elif auto_augment == "randaugment":
+        tfl.append(v2.RandAugment(interpolation=v2.InterpolationMode.BILINEAR))
+    elif auto_augment == "augmix":
+        tfl.append(v2.AugMix(interpolation=v2.InterpolationMode.BILINEAR))
+    elif auto_augment == "autoaugment":
+        tfl.append(v2.AutoAugment(interpolation=v2.InterpolationMode.BILINEAR))
+    else:
+        # 与 Ultralytics 的 classify_augmentations 一致：配置拼写错误时直接报错，而不是悄悄换成其他增强
+        raise ValueError(
+            f'Invalid auto_augment policy: {auto_augment}. Should be one of "randaugment", '
+            f'"augmix", "autoaugment" or None'
+        )
+    # 擦除在归一化之前以 0 填充 uint8 图像；在默认的 mean=0/std=1 下与 Ultralytics 的顺序等价
+    tfl += [v2.RandomErasing(p=args.erasing, value=0), *tail]
+    return v2.Compose(tfl)
+
 
 class CustomClassificationDataset(ClassificationDataset):
     """
     这是一个自定义的数据集类，它继承自 Ultralytics 的 ClassificationDataset，
     但重写了 __getitem__ 方法以使用 Pillow (`Image.open`) 而不是 OpenCV (`cv2.imread`)
     来加载图片。这旨在解决 `cv2.imread` 在处理某些特定图片时可能发生的挂起问题。
+    如果安装了 PyTurboJPEG，JPEG 图片会优先使用 libjpeg-turbo 解码。解码结果以
+    numpy 数组直接送入 torchvision v2 张量变换，不再经过 PIL 图像。__getitem__ 只负责读取
+    原始字节，解码和变换在 collate_fn 中按批次用线程池并行完成，归一化对整个批次一次完成
+    （可选用 torch.compile 融合为单个内核）。
     """
 
+    # 单个样本的最大加载尝试次数（首次为请求的索引，其余为随机索引）
+    max_retries = 3
+    # 已确认损坏的文件，后续 epoch 直接跳过（每个 worker 进程各自维护一份）
+    _bad_files = set()
+    # collate_fn 中每个 worker 进程用于并行解码的线程数
+    decode_threads = 8
+    # 是否用 torch.compile 编译批次归一化。每个 worker 进程都要单独编译一次，在默认 mean=0/std=1
+    # 下收益有限，因此默认关闭（train_robust.py 的 --compile-normalize 开启）
+    compile_normalize = False
+
+    def __init__(self, root: str, args, augment: bool = False, prefix: str = "", **kwargs):
+        # 其余关键字参数（例如新版 Ultralytics 传入的 names）原样交给父类，兼容不同版本的签名
+        super().__init__(root, args, augment=augment, prefix=prefix, **kwargs)
+        # 训练输入尺寸，用于在解码阶段直接缩小到接近目标分辨率
+        imgsz = args.imgsz
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        # 用直接处理张量的 v2 变换替换默认的 PIL 变换，省去 numpy -> PIL -> 张量的往返拷贝。
+        # torch_transforms 保持完整的归一化流水线：训练器会把它作为 model.transforms 保存进权重，
+        # 推理时 ClassificationPredictor 直接用它处理图片
+        self.torch_transforms = build_tensor_transforms(self.imgsz, args, augment=augment)
+        # collate_fn 中逐样本只做 uint8 变换，类型转换和归一化对整个批次一次完成
+        self.uint8_transforms = build_tensor_transforms(self.imgsz, args, augment=augment, normalize=False)
+        self.normalize = Normalize()
+        self.compile_normalize = type(self).compile_normalize  # 写入实例，spawn 模式的 worker 也能拿到
+        self._decode_pool = None  # 在 collate_fn 中按需创建
+
+    def _scaling_factor(self, w: int, h: int) -> tuple:
+        """选出使短边仍不小于 imgsz 的最小 TurboJPEG DCT 缩放因子。"""
+        short = min(w, h)
+        best = (1, 1)
+        for num, den in _TJ.scaling_factors:
+            if num * short >= self.imgsz * den and num * best[1] < best[0] * den:
+                best = (num, den)
+        return best
+
+    def decode(self, buf: bytes, f: str) -> np.ndarray:
+        """
+        把图片字节解码为 RGB 数组。JPEG 优先走 TurboJPEG，其他格式或解码失败时回退到 Pillow。
+        两条路径都会利用 libjpeg 的 DCT 域缩放，直接解码到不小于 imgsz 的分辨率。
+
+        Args:
+            buf (bytes): 图片文件的原始字节。
+            f (str): 图片路径，仅用于按后缀判断格式。
+
+        Returns:
+            (np.ndarray): HxWx3 的 uint8 RGB 数组。
+        """
+        if _TJ is not None and Path(f).suffix.lower() in JPEG_SUFFIXES:
+            try:
+                w, h, _, _ = _TJ.decode_header(buf)
+                return _TJ.decode(buf, pixel_format=TJPF_RGB, scaling_factor=self._scaling_factor(w, h))
+            except Exception:
+                pass  # 交给下面的 Pillow 路径处理
+        with Image.open(io.BytesIO(buf)) as im:
+            im.draft("RGB", (self.imgsz, self.imgsz))  # 仅对 JPEG 生效，其他格式为空操作
+            return np.asarray(im.convert("RGB"))
+
+    def load_image(self, f: str) -> np.ndarray:
+        """
+        读取并解码一张 RGB 图片。
+
+        Args:
+            f (str): 图片路径。
+
+        Returns:
+            (np.ndarray): HxWx3 的 uint8 RGB 数组。
+        """
+        with open(f, "rb") as fh:
+            return self.decode(fh.read(), f)
+
+    def cache_path(self, f: str) -> Path:
+        """
+        返回样本的磁盘缓存路径。后缀中带上 imgsz：缓存的是按 imgsz 做过 DCT 缩放的 RGB 数组，
+        既不能在更换 imgsz 后复用，也不能与 Ultralytics 原生 cache=disk 写入的全尺寸 BGR `.npy` 混用。
+        """
+        return Path(f).with_suffix(f".rgb{self.imgsz}.npy")
+
+    def load_cached(self, f: str) -> np.ndarray:
+        """
+        带磁盘缓存的加载：首次访问时把解码结果保存为 .npy，之后以内存映射方式读取，
+        后续 epoch 不再需要解码，热数据直接由操作系统页缓存提供。图片被重新清理
+        （比缓存更新）时缓存自动失效。
+
+        Args:
+            f (str): 图片路径。
+
+        Returns:
+            (np.ndarray): HxWx3 的 uint8 RGB 数组（可能是只读的内存映射）。
+        """
+        fn = self.cache_path(f)
+        if fn.exists() and fn.stat().st_mtime >= os.path.getmtime(f):
+            return np.load(fn, mmap_mode="r")
+        im = self.load_image(f)
+        # 先写临时文件再原子替换，避免中断时留下不完整的缓存
+        tmp = fn.with_name(f"{fn.stem}.{os.getpid()}.tmp.npy")
+        np.save(tmp.as_posix(), im, allow_pickle=False)
+        os.replace(tmp, fn)
+        return im
+
     def __getitem__(self, i: int) -> dict:
         """
-        通过使用 Pillow 加载图片来返回样本。
+        读取样本的原始 JPEG 字节（启用磁盘缓存时为已解码的数组），解码和变换推迟到
+        `collate_fn` 中按批并行完成。读取失败时最多再尝试 `max_retries - 1` 个随机样本，
+        解码失败则由 `collate_fn` 负责替换。
 
         Args:
             i (int): 样本索引。
 
         Returns:
-            (dict): 包含图像张量和类别索引的字典。
+            (dict): 包含 "buf"（原始字节）或 "im"（已解码数组）、类别索引和路径的字典。
         """
-        f, j, fn, im = self.samples[i]  # filename, index, filename.with_suffix('.npy'), image
+        for attempt in range(self.max_retries):
+            # 第一次尝试请求的索引，之后换成随机索引；已知损坏的文件直接跳过
+            k = i if attempt == 0 else np.random.randint(len(self))
+            f, j = self.samples[k][:2]  # filename, index
+            if f in self._bad_files:
+                continue
+
+            try:
+                if self.cache_disk:
+                    return {"buf": None, "im": self.load_cached(f), "cls": j, "path": f}
+                with open(f, "rb") as fh:
+                    return {"buf": fh.read(), "im": None, "cls": j, "path": f}
+            except Exception as e:
+                LOGGER.warning(f"WARNING ⚠️ Error loading image {f}: {e}")
+                self._bad_files.add(f)
+
+        # 多次尝试都失败时交给 collate_fn 继续替换，最终退回全零图像，保证数据加载管道不会被损坏文件拖垮
+        return {"buf": None, "im": None, "cls": self.samples[i][1], "path": None}
 
-        # 核心修改：使用 Pillow (Image.open) 替代 OpenCV (cv2.imread)
+    def _to_tensor(self, item: dict):
+        """解码（如有需要）并变换单个样本，返回 uint8 张量；解码失败时返回 None 并记录损坏文件。"""
+        f, im = item["path"], item["im"]
+        if f is None:
+            return None
         try:
-            # 直接使用 Pillow 加载图片并转换为 RGB
-            # 这可以避免 cv2.imread 挂起和后续的 BGR->RGB 转换
-            im = Image.open(f).convert("RGB")
+            # 核心修改：使用 TurboJPEG / Pillow 替代 OpenCV (cv2.imread)，
+            # 直接解码为 RGB，这可以避免 cv2.imread 挂起和后续的 BGR->RGB 转换
+            if im is None:
+                im = self.decode(item["buf"], f)
         except Exception as e:
-            LOGGER.warning(f"WARNING ⚠️ Error loading image {f} with Pillow: {e}")
-            # 如果一张图片损坏，返回数据集中另一张随机图片的副本
-            return self.__getitem__(np.random.randint(len(self)))
-
-        # 缓存逻辑保持不变，但现在缓存的是 Pillow 加载的、已经是 NumPy 数组的图像
-        # 注意：原始代码的缓存逻辑可能仍然依赖于 cv2，这里我们简化处理，
-        # 总是从磁盘加载。如果需要缓存，需要更复杂的逻辑来处理 Pillow 对象。
-        # 为了调试，我们暂时忽略缓存，以确保核心加载逻辑正确。
-
-        # if self.cache_ram and im is None:
-        #     # 对于 RAM 缓存，我们已经加载了 im
-        #     self.samples[i][3] = np.array(im)
-        # elif self.cache_disk:
-        #     if not fn.exists():
-        #         np.save(fn.as_posix(), np.array(im), allow_pickle=False)
-        #     im = np.load(fn)
-
-        # 应用变换
-        sample = self.torch_transforms(im)
-        return {"img": sample, "cls": j} 
+            LOGGER.warning(f"WARNING ⚠️ Error loading image {f}: {e}")
+            self._bad_files.add(f)
+            return None
+
+        # HWC 数组零拷贝视为 CHW 张量（只读的内存映射需要先复制一次）
+        im = torch.from_numpy(np.require(im, requirements=["C", "W"])).permute(2, 0, 1)
+        return self.uint8_transforms(im)
+
+    def _load_sample(self, item: dict) -> tuple:
+        """
+        把 `__getitem__` 的结果变成 (图像张量, 类别)。损坏的文件要到解码时才会暴露，
+        因此解码失败时在这里最多再换 `max_retries - 1` 个随机样本，仍失败才返回全零图像。
+        """
+        cls = item["cls"]
+        for _ in range(self.max_retries):
+            im = self._to_tensor(item)
+            if im is not None:
+                return im, item["cls"]
+            item = self[np.random.randint(len(self))]
+        return torch.zeros(3, self.imgsz, self.imgsz, dtype=torch.uint8), cls
+
+    def collate_fn(self, batch: list) -> dict:
+        """
+        在线程池中并行解码和变换整个批次，再对堆叠后的批次统一做归一化。libjpeg-turbo 和
+        torch 算子在 C 代码中释放 GIL，因此单个 dataloader worker 内即可同时解码多张图片。
+        Ultralytics 的 build_dataloader 会自动使用数据集上的 `collate_fn`。
+
+        Args:
+            batch (list): `__getitem__` 返回的样本列表。
+
+        Returns:
+            (dict): 包含堆叠后的图像张量 "img" 和类别张量 "cls" 的字典。
+        """
+        if self._decode_pool is None:
+            self._decode_pool = ThreadPoolExecutor(max_workers=self.decode_threads)
+        imgs, cls = zip(*self._decode_pool.map(self._load_sample, batch))
+        return {"img": self._normalize(torch.stack(imgs)), "cls": torch.tensor(cls)}
+
+    def _normalize(self, imgs: torch.Tensor) -> torch.Tensor:
+        """
+        对整个 uint8 批次做类型转换、减均值和除方差。启用 `compile_normalize` 时交给
+        `normalize_compiled`，把这些逐元素运算融合为一个向量化内核。
+        """
+        if self.compile_normalize:
+            return normalize_compiled(self.normalize, imgs)
+        return self.normalize(imgs)
+
+    def __getstate__(self):
+        # 线程池无法被 pickle（spawn 模式的 worker 会序列化数据集），由各进程按需重建
+        state = self.__dict__.copy()
+        state["_decode_pool"] = None
+        return state
+
+
+class ShardDataset(Dataset):
+    """
+    读取 `pack_shards` 生成的定长记录二进制分片。每个 worker 进程只打开一次内存映射，
+    取样本只是一次内存拷贝，对机械硬盘和网络存储友好。
+    """
+
+    def __init__(self, shard_dir: str, transforms=None):
+        """
+        Args:
+            shard_dir (str): 包含 shard.bin、labels.i32 和 index.json 的目录。
+            transforms (callable, optional): 作用于 uint8 CHW 张量的变换，例如 `build_tensor_transforms` 的结果。
+        """
+        self.shard_dir = Path(shard_dir)
+        index = json.loads((self.shard_dir / "index.json").read_text())
+        self.shape = tuple(index["shape"])
+        self.classes = index["classes"]
+        self.labels = np.fromfile(self.shard_dir / "labels.i32", dtype=np.int32)
+        self.transforms = transforms
+        self._mm = None  # 在各 worker 进程中按需打开
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, i: int) -> dict:
+        if self._mm is None:
+            self._mm = np.memmap(self.shard_dir / "shard.bin", dtype=np.uint8, mode="r", shape=self.shape)
+        im = torch.from_numpy(np.array(self._mm[i])).permute(2, 0, 1)
+        if self.transforms is not None:
+            im = self.transforms(im)
+        return {"img": im, "cls": int(self.labels[i])}
+
+    def __getstate__(self):
+        # 内存映射不随数据集一起序列化，由各 worker 进程重新打开
+        state = self.__dict__.copy()
+        state["_mm"] = None
+        return state
@@ -1,10 +1,21 @@
+import io
+import json
 import os
+from functools import partial
 from pathlib import Path
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageOps
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import argparse
 
+# PyTurboJPEG 为可选依赖：可用时使用 libjpeg-turbo 直接从 numpy 缓冲区编码 JPEG
+try:
+    from turbojpeg import TJPF_RGB, TJSAMP_420, TurboJPEG
+    _TJ = TurboJPEG()
+except (ImportError, OSError):
+    _TJ = None
+
 # Pillow 的图像大小限制，以防止解压缩炸弹
 Image.MAX_IMAGE_PIXELS = None 
 
@@ -13,40 +24,142 @@ Image.MAX_IMAGE_PIXELS = None
 MAX_RESOLUTION_BEFORE_RESIZE = (2048, 2048)
 TARGET_SIZE_AFTER_RESIZE = (1024, 1024)
 
-def sanitize_image(args):
+# 输出 JPEG 的质量。清理后的图片每个 epoch 都会被重新解码，因此统一输出
+# baseline（非 progressive）、4:2:0 色度抽样的 JPEG：解码更快、文件更小。
+# 90 对训练而言与 95 几乎没有可见差异，但体积约小 30%。
+JPEG_QUALITY = 90
+
+# 记录上次清理参数的文件（位于目标目录根部）。增量处理只比较 mtime，
+# 因此更换 JPEG 质量后需要靠它发现已有输出已过时
+SANITIZE_META = ".sanitize_meta.json"
+
+# 打包分片时每个样本被统一缩放/裁剪到的边长
+SHARD_IMAGE_SIZE = 256
+
+# 支持的图片格式（小写后缀）
+SUPPORTED_FORMATS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp"}
+
+def read_file(path: str) -> bytes:
     """
-    工作函数：验证、缩放和转换单个图像。
+    一次性读取整个文件。在支持的平台 (Linux) 上先提示内核顺序读取以启用预读，
+    读完后提示内核丢弃这些页缓存，避免大数据集清理时把页缓存挤满（对 NFS/Lustre 尤其明显）。
     """
-    src_path, dest_path = args
+    fd = os.open(path, os.O_RDONLY)
     try:
-        dest_dir = os.path.dirname(dest_path)
-        os.makedirs(dest_dir, exist_ok=True)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        size = os.fstat(fd).st_size
+        chunks = []
+        while size > 0:
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return b"".join(chunks)
+    finally:
+        os.close(fd)
 
-        with Image.open(src_path) as img:
+def sanitize_image(args, quality=JPEG_QUALITY):
+    """
+    工作函数：验证、缩放和转换单个图像。目标目录需由调用方预先创建。
+    """
+    src_path, dest_path = args
+    # 先写入临时文件再原子替换：中途被中断或磁盘写满时不会留下 mtime 较新的残缺 JPEG，
+    # 否则增量处理会把它当作已是最新而永久跳过
+    tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+    try:
+        # 为控制多线程并发时的峰值内存，每一步的中间图像用完立即释放，同一时刻只保留一份像素缓冲区
+        with Image.open(io.BytesIO(read_file(src_path))) as src_img:
+            oversized = (src_img.width > MAX_RESOLUTION_BEFORE_RESIZE[0]
+                         or src_img.height > MAX_RESOLUTION_BEFORE_RESIZE[1])
+            if oversized:
+                # 对 JPEG，draft 让 libjpeg 在解码时直接按 1/2、1/4、1/8 缩小，其他格式为空操作
+                src_img.draft("RGB", TARGET_SIZE_AFTER_RESIZE)
             # 1. 统一转换为 RGB
-            img = img.convert("RGB")
+            img = src_img.convert("RGB")
 
+        try:
             # 2. 检查分辨率并按需缩放
-            if img.width > MAX_RESOLUTION_BEFORE_RESIZE[0] or img.height > MAX_RESOLUTION_BEFORE_RESIZE[1]:
-                # 按比例缩放，保持长宽比
-                img.thumbnail(TARGET_SIZE_AFTER_RESIZE, Image.LANCZOS)
+            if oversized:
+                # 先用整数倍的盒式滤波快速缩小（C 实现，开销远低于 LANCZOS），
+                # 再用 BILINEAR 按比例缩放到目标尺寸，保持长宽比
+                factor = max(1, min(img.width // TARGET_SIZE_AFTER_RESIZE[0],
+                                    img.height // TARGET_SIZE_AFTER_RESIZE[1]))
+                if factor > 1:
+                    reduced = img.reduce(factor)
+                    img.close()
+                    img = reduced
+                img.thumbnail(TARGET_SIZE_AFTER_RESIZE, Image.BILINEAR)
+
+            # 3. 统一保存为 baseline、4:2:0 抽样的 JPEG
+            if _TJ is not None:
+                jpeg_bytes = _TJ.encode(np.asarray(img), quality=quality, pixel_format=TJPF_RGB,
+                                        jpeg_subsample=TJSAMP_420)
+                Path(tmp_path).write_bytes(jpeg_bytes)
+            else:
+                img.save(tmp_path, "JPEG", quality=quality, subsampling=2, progressive=False, optimize=False)
+        finally:
+            img.close()
+        os.replace(tmp_path, dest_path)
 
-            # 3. 统一保存为高质量 JPEG
-            img.save(dest_path, "JPEG", quality=95)
-        
         return None  # 表示成功
     except Exception as e:
+        # 清理写了一半的临时文件
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
         return f"Error processing {src_path}: {e}"
 
-def sanitize_dataset(source_dir: str, dest_dir: str, force_rescan=False, workers=None):
+def iter_tasks(source_path: Path, dest_path: Path, force_rescan=False, stats=None):
+    """
+    遍历原始数据集，逐个产出待处理的 (源路径, 目标路径) 任务。
+
+    只遍历一次目录树，并按小写后缀匹配（同时覆盖 .JPG、.Jpg 等写法）。
+    非强制模式下会跳过目标文件已存在且不比源文件旧的图片，使重复运行只处理新增/修改的文件。
+    每个目标目录只在第一次产出其中的任务前创建一次，避免每张图片都触发 mkdir 系统调用。
+
+    Args:
+        source_path (Path): 原始数据集的根目录。
+        dest_path (Path): 清理后数据集的根目录。
+        force_rescan (bool): 是否强制处理所有图片。
+        stats (dict): 可选，用于累计 "found" 和 "skipped" 计数。
+
+    Yields:
+        (tuple): (str, str) 形式的源路径与目标路径。
+    """
+    stats = stats if stats is not None else {"found": 0, "skipped": 0}
+    for root, _, files in os.walk(source_path):
+        dest_root = dest_path / Path(root).relative_to(source_path)
+        dest_root_created = False
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in SUPPORTED_FORMATS:
+                continue
+            stats["found"] += 1
+            src = os.path.join(root, name)
+            dest = str((dest_root / name).with_suffix(".jpg"))
+            if not force_rescan and os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(src):
+                stats["skipped"] += 1
+                continue
+            if not dest_root_created:
+                os.makedirs(dest_root, exist_ok=True)
+                dest_root_created = True
+            yield src, dest
+
+def sanitize_dataset(source_dir: str, dest_dir: str, force_rescan=False, workers=None, quality=JPEG_QUALITY):
     """
     清理和预处理整个数据集。
 
     Args:
         source_dir (str): 原始数据集的路径 (例如 './raw_data')。
         dest_dir (str): 清理后数据集的存放路径 (例如 './dataset_sanitized')。
-        force_rescan (bool): 是否强制重新扫描和处理所有图片。
-        workers (int): 使用的工作进程数。
+        force_rescan (bool): 是否强制重新处理所有图片。默认只处理新增或比目标文件更新的图片；
+            若 quality 与上次记录的不同，也会重新处理所有图片。
+        workers (int): 使用的工作线程数。
+        quality (int): 输出 JPEG 的质量。
     """
     source_path = Path(source_dir).resolve()
     dest_path = Path(dest_dir).resolve()
@@ -55,41 +168,51 @@ def sanitize_dataset(source_dir: str, dest_dir: str, force_rescan=False, workers
     print(f"原始数据源: {source_path}")
     print(f"目标文件夹: {dest_path}")
 
-    if dest_path.exists() and not force_rescan:
-        print("✅ 清理过的目标文件夹已存在，跳过处理。如需强制重新处理，请使用 --force-rescan 标志。")
-        return True
+    # 已有输出使用的 JPEG 质量与本次不同时，mtime 比较无法发现，必须全部重新处理
+    meta_path = dest_path / SANITIZE_META
+    try:
+        previous_quality = json.loads(meta_path.read_text()).get("jpeg_quality")
+    except (OSError, ValueError):
+        previous_quality = None
+    if not force_rescan and previous_quality is not None and previous_quality != quality:
+        print(f"⚠️ JPEG 质量已从 {previous_quality} 改为 {quality}，将重新处理所有图片。")
+        force_rescan = True
 
-    # 搜集所有待处理的图片任务
-    tasks = []
-    supported_formats = [".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp"]
-    print("正在搜集图片文件...")
-    for ext in supported_formats:
-        tasks.extend(source_path.rglob(f"*{ext.lower()}"))
-        tasks.extend(source_path.rglob(f"*{ext.upper()}"))
+    # 使用线程池进行处理：解码、缩放、编码和文件读写都在 C 代码中释放 GIL，
+    # 线程即可并行利用多核，同时省去了进程 fork 和任务参数的序列化开销。
+    # 任务以生成器的形式边扫描边提交，且同时在途的任务数有上限，
+    # 既不需要先把百万级的任务列表整体放进内存，第一批图片也能立即开始处理。
+    num_workers = workers if workers is not None else min(16, os.cpu_count() or 1)
+    max_pending = num_workers * 64
+    stats = {"found": 0, "skipped": 0}
+    errors = []
+
+    def collect(done):
+        for future in done:
+            result = future.result()
+            if result:
+                errors.append(result)
+            pbar.update()
+
+    print(f"正在扫描图片并使用 {num_workers} 个工作线程处理...")
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, tqdm(desc="清理图片中") as pbar:
+        pending = set()
+        for task in iter_tasks(source_path, dest_path, force_rescan, stats):
+            pending.add(executor.submit(sanitize_image, task, quality))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(as_completed(pending))
 
-    if not tasks:
+    if stats["found"]:
+        dest_path.mkdir(parents=True, exist_ok=True)
+        meta_path.write_text(json.dumps({"jpeg_quality": quality}))
+
+    if not stats["found"]:
         print(f"❌ 在 '{source_path}' 中未找到任何支持的图片。")
         return False
-        
-    print(f"共找到 {len(tasks)} 张图片需要处理。")
-
-    # 创建处理任务列表
-    process_tasks = []
-    for src_img_path in tasks:
-        relative_p = src_img_path.relative_to(source_path)
-        dest_img_path = (dest_path / relative_p).with_suffix(".jpg")
-        process_tasks.append((str(src_img_path), str(dest_img_path)))
-
-    # 使用多进程进行处理
-    num_workers = workers if workers is not None else min(16, cpu_count())
-    errors = []
-    print(f"使用 {num_workers} 个工作进程开始处理...")
-    with Pool(num_workers) as pool:
-        with tqdm(total=len(process_tasks), desc="清理图片中") as pbar:
-            for result in pool.imap_unordered(sanitize_image, process_tasks):
-                if result:
-                    errors.append(result)
-                pbar.update()
+
+    print(f"共找到 {stats['found']} 张图片，跳过 {stats['skipped']} 张已清理且未修改的图片。")
 
     if errors:
         print("\n--- ⚠️ 清理过程中发生错误 ---")
@@ -100,13 +223,88 @@ def sanitize_dataset(source_dir: str, dest_dir: str, force_rescan=False, workers
     print("\n✅ 数据集清理成功！")
     return True
 
+def _pack_record(mm: np.memmap, size: int, idx: int, path: Path):
+    """把一张图片缩放并中心裁剪为 size x size 后写入分片的第 idx 条记录。"""
+    with Image.open(path) as img:
+        img.draft("RGB", (size, size))
+        mm[idx] = np.asarray(ImageOps.fit(img.convert("RGB"), (size, size), Image.BILINEAR))
+
+def pack_shards(dest_dir: str, size=SHARD_IMAGE_SIZE, workers=None, force=False):
+    """
+    把清理后的数据集按划分（train/val/test）打包成定长记录的顺序二进制分片，
+    使训练时的随机小文件读取变成对单个大文件的内存映射访问。
+
+    每个划分输出到 `<dest_dir>/shards/<split>/`：
+        shard.bin   : N x size x size x 3 的 uint8 数组，按类别排序
+        labels.i32  : N 个 int32 类别索引
+        index.json  : 形状、类别名以及每个类别在分片中的起始位置
+
+    Args:
+        dest_dir (str): 清理后数据集的路径 (例如 './dataset_sanitized')。
+        size (int): 每个样本缩放并中心裁剪后的边长。
+        workers (int): 使用的工作线程数。
+        force (bool): 即使分片已是最新也重新打包。
+    """
+    dest_path = Path(dest_dir).resolve()
+    num_workers = workers if workers is not None else min(16, os.cpu_count() or 1)
+    print("--- 打包数据集分片 ---")
+
+    for split_dir in sorted(p for p in dest_path.iterdir() if p.is_dir() and p.name != "shards"):
+        classes = sorted(p.name for p in split_dir.iterdir() if p.is_dir())
+        files, labels, offsets = [], [], []
+        for j, name in enumerate(classes):
+            offsets.append(len(files))
+            class_files = sorted(p for p in (split_dir / name).iterdir() if p.suffix.lower() == ".jpg")
+            files.extend(class_files)
+            labels.extend([j] * len(class_files))
+        if not files:
+            continue
+
+        out_dir = dest_path / "shards" / split_dir.name
+        index_path = out_dir / "index.json"
+        # 只看 .jpg 文件本身：类别和图片数量不变、且 index.json 比所有图片都新时说明分片已是最新。
+        # 不能用目录 mtime，--cache disk 写入的 .npy 缓存也会更新类别目录的 mtime
+        if not force and index_path.exists():
+            try:
+                index = json.loads(index_path.read_text())
+            except ValueError:
+                index = {}
+            newest = max(p.stat().st_mtime for p in files)
+            if (index.get("classes") == classes and index.get("shape", [None])[0] == len(files)
+                    and index_path.stat().st_mtime > newest):
+                print(f"✅ {split_dir.name}: 分片已是最新，跳过打包。")
+                continue
+        out_dir.mkdir(parents=True, exist_ok=True)
+        index_path.unlink(missing_ok=True)  # 打包完成前不留下有效的索引
+        shape = (len(files), size, size, 3)
+        mm = np.memmap(out_dir / "shard.bin", dtype=np.uint8, mode="w+", shape=shape)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            records = executor.map(partial(_pack_record, mm, size), range(len(files)), files)
+            list(tqdm(records, total=len(files), desc=f"打包 {split_dir.name}"))
+        mm.flush()
+        del mm
+
+        np.asarray(labels, dtype=np.int32).tofile(out_dir / "labels.i32")
+        index = {"shape": list(shape), "dtype": "uint8", "classes": classes, "offsets": offsets}
+        index_path.write_text(json.dumps(index, ensure_ascii=False, indent=2))
+        print(f"✅ {split_dir.name}: {len(files)} 张图片已写入 {out_dir}")
+
 if __name__ == '__main__':
     # 允许此脚本被直接调用，以进行手动数据清理
     parser = argparse.ArgumentParser(description="一站式数据集健康检查与预处理工具。")
     parser.add_argument("source", type=str, help="原始数据集的根目录。")
     parser.add_argument("destination", type=str, help="处理后数据的存放目录。")
-    parser.add_argument("--workers", type=int, default=None, help="工作进程数（默认：min(16, cpu_cores)）。")
-    parser.add_argument("--force-rescan", action="store_true", help="即使目标目录已存在，也强制重新扫描和处理。")
+    parser.add_argument("--workers", type=int, default=None, help="工作线程数（默认：min(16, cpu_cores)）。")
+    parser.add_argument("--force-rescan", action="store_true", help="强制重新处理所有图片，即使目标文件已是最新。")
+    parser.add_argument("--jpeg-quality", type=int, default=JPEG_QUALITY,
+                        help="输出 JPEG 质量（默认：90）。输出始终为 baseline、4:2:0 抽样，每个 epoch 解码更快；"
+                             "90 与 95 对训练几乎无差别但文件约小 30%%，调高会增大磁盘 IO。"
+                             "更改质量后会自动重新处理所有已清理的图片。")
+    parser.add_argument("--pack-shards", action="store_true",
+                        help="清理完成后把数据集打包成定长记录的顺序二进制分片（shards/ 目录），已是最新的划分会被跳过。")
     args = parser.parse_args()
     
-    sanitize_dataset(args.source, args.destination, args.force_rescan, args.workers) 
+    if sanitize_dataset(args.source, args.destination, args.force_rescan, args.workers, args.jpeg_quality) \
+            and args.pack_shards:
+        pack_shards(args.destination, workers=args.workers, force=args.force_rescan)